@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2019-2020 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# Benchmark eno2table.py on a synthetic SUBJECTS_DIR, timing extraction
+# in each mode and table writing for increasing numbers of subjects.
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import eno2table
+
+FILLER = (
+    '#--------------------------------------------\n'
+    '#@# CA Reg {subject} {line}\n'
+    'mri_ca_register -rusage touch/rusage.mri_ca_register.dat -nobigventricles '
+    '-T transforms/talairach.lta -align-after -mask brainmask.mgz norm.mgz\n'
+    '{line:06d}: dt=0.000250, rms=0.4{line:05d}, neg=0, invalid=762\n'
+)
+
+HEADER = (
+    'Mon Mar 23 10:00:00 CET 2020\n'
+    '/neurospin/imagen/FU3/processed/freesurfer/{subject}\n'
+    '/drf/local/freesurfer-6.0.0/bin/recon-all\n'
+    '-clean -subjid {subject} -all\n'
+    'build-stamp.txt: freesurfer-Linux-centos6_x86_64-stable-pub-v6.0.0-2beb96c\n'
+)
+
+EULER = (
+    'orig.nofix lheno = {lheno:4d}, rheno = {rheno:4d}\n'
+    'orig.nofix lhholes = {lhholes:3d}, rhholes = {rhholes:3d}\n'
+)
+
+FOOTER = (
+    '#@#%# recon-all-run-time-hours {hours:.3f}\n'
+    'recon-all -s {subject} finished without error at Mon Mar 23 18:00:00 CET 2020\n'
+)
+
+
+def _filler(subject, size, start=0):
+    lines = []
+    length = 0
+    line = start
+    while length < size:
+        text = FILLER.format(subject=subject, line=line)
+        lines.append(text)
+        length += len(text)
+        line += 1
+    return ''.join(lines), line
+
+
+# a recon-all.log of about size bytes with the Euler numbers at a given
+# relative position
+def write_logfile(logfile, subject, size, position):
+    rng = random.Random(subject)
+    lheno = -2 * rng.randint(1, 60) + 2
+    rheno = -2 * rng.randint(1, 60) + 2
+    before, line = _filler(subject, int(size * position))
+    after, _ = _filler(subject, size - len(before), line)
+    with open(logfile, 'w') as f:
+        f.write(HEADER.format(subject=subject))
+        f.write(before)
+        f.write(EULER.format(lheno=lheno, rheno=rheno,
+                             lhholes=(2 - lheno) // 2,
+                             rhholes=(2 - rheno) // 2))
+        f.write(after)
+        f.write(FOOTER.format(subject=subject, hours=rng.uniform(5, 12)))
+
+
+def create_subjects_dir(subjects_dir, count, size, position):
+    subjects = ['{:012d}'.format(i) for i in range(count)]
+    for subject in subjects:
+        scripts = os.path.join(subjects_dir, subject, 'scripts')
+        os.makedirs(scripts, exist_ok=True)
+        write_logfile(os.path.join(scripts, 'recon-all.log'),
+                      subject, size, position)
+    return subjects
+
+
+def _timed(function, *args, **kwargs):
+    # eno2table.py reports progress on standard output
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return time.perf_counter() - start, result
+
+
+def benchmark(subjects_dir, subjects, metrics, jobs, prefetch, tablefile):
+    timings = []
+    harvest = eno2table.harvest_logs
+    t, result = _timed(harvest, subjects, metrics, subjects_dir=subjects_dir)
+    timings.append(('serial', t))
+    if jobs > 1:
+        t, _ = _timed(harvest, subjects, metrics, jobs,
+                      subjects_dir=subjects_dir)
+        timings.append(('jobs={}'.format(jobs), t))
+    if prefetch > 0:
+        t, _ = _timed(harvest, subjects, metrics, subjects_dir=subjects_dir,
+                      prefetch=prefetch)
+        timings.append(('prefetch={}'.format(prefetch), t))
+    cache = {}
+    t, _ = _timed(harvest, subjects, metrics, jobs, cache, subjects_dir)
+    timings.append(('cache cold', t))
+    t, _ = _timed(harvest, subjects, metrics, jobs, cache, subjects_dir)
+    timings.append(('cache warm', t))
+    t, _ = _timed(eno2table.write_log_table, tablefile, result, metrics)
+    timings.append(('write table', t))
+    return timings
+
+
+def _size(text):
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    if text and text[-1].lower() in units:
+        return int(float(text[:-1]) * units[text[-1].lower()])
+    return int(text)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark eno2table.py on synthetic FreeSurfer subjects.')
+    parser.add_argument('-n', '--subjects',
+                        type=int,
+                        nargs='+',
+                        default=[100, 1000, 10000],
+                        help='numbers of subjects to benchmark')
+    parser.add_argument('--log-size',
+                        type=_size,
+                        default='1M',
+                        help='approximate size of each recon-all.log '
+                             '(default: 1M)')
+    parser.add_argument('--euler-position',
+                        type=float,
+                        default=0.6,
+                        help='relative position of the Euler numbers '
+                             'in the log file, between 0 and 1')
+    parser.add_argument('-m', '--metrics',
+                        nargs='+',
+                        default=['euler'],
+                        choices=[x[0] for x in eno2table.LOG_PATTERNS],
+                        help='metrics to extract')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of threads of the --jobs mode')
+    parser.add_argument('--prefetch',
+                        type=int,
+                        default=8,
+                        help='depth of the --prefetch mode')
+    parser.add_argument('--workdir',
+                        help='where to create the synthetic subjects, on '
+                             'the filesystem to benchmark (default: a '
+                             'temporary directory, removed afterwards)')
+    args = parser.parse_args(argv[1:])
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_eno2table_')
+    try:
+        subjects_dir = os.path.join(workdir, 'subjects')
+        count = max(args.subjects)
+        print('Creating {} subjects in {}'.format(count, subjects_dir))
+        subjects = create_subjects_dir(subjects_dir, count, args.log_size,
+                                       args.euler_position)
+        # note that the log files are likely to be in the page cache
+        print('{:>8} {:>14} {:>10} {:>12}'.format('subjects', 'mode',
+                                                   'seconds', 'subjects/s'))
+        for n in sorted(args.subjects):
+            tablefile = os.path.join(workdir, 'euler.tsv')
+            for mode, t in benchmark(subjects_dir, subjects[:n],
+                                     args.metrics, args.jobs, args.prefetch,
+                                     tablefile):
+                print('{:>8} {:>14} {:>10.3f} {:>12.0f}'.format(
+                    n, mode, t, n / t if t else float('inf')))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
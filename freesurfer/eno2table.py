@@ -32,12 +32,40 @@
 # processed by FreeSurfer.
 
 import argparse
+import collections
+import concurrent.futures
 import csv
+import fnmatch
+import functools
+import itertools
+import json
+import mmap
 import os
 import re
 import sys
 
-ENO_REGEX = re.compile(r'orig.nofix lheno +=\s+(-?\d+), +rheno +=\s+(-?\d+)')
+# log files may hold bytes that are not UTF-8
+def _decode(value):
+    return value.decode(errors='replace')
+
+
+# patterns matched at the start of a line of recon-all.log: metric, table
+# columns, regex, occurrence kept when the log holds several runs, and value
+# type; the patterns start with a literal prefix and are not anchored, so
+# that re can skip ahead to that prefix
+LOG_PATTERNS = [
+    ('euler', ('rheno', 'lheno'),
+     rb'orig\.nofix lheno +=\s+(-?\d+), +rheno +=\s+(-?\d+)', 'first', int),
+    ('holes', ('lhholes', 'rhholes'),
+     rb'orig\.nofix lhholes +=\s+(\d+), +rhholes +=\s+(\d+)', 'first', int),
+    ('runtime', ('runtime_hours',),
+     rb'#@#%# recon-all-run-time-hours +([\d.]+)', 'last', float),
+    ('version', ('version',),
+     rb'build-stamp\.txt: +(\S+)', 'last', _decode),
+    ('status', ('status',),
+     rb'recon-all -s \S+ (finished without error|exited with ERRORS)', 'last',
+     _decode),
+]
 
 DELIMITER = [
     ('tab', '\t'),
@@ -46,41 +74,328 @@ DELIMITER = [
     ('semicolon', ';'),
 ]
 
+# binary formats of the optional columnar copy of the tables
+BINARY_FORMAT = [
+    ('npz', '.npz'),
+    ('arrow', '.arrow'),
+]
 
-def extract_euler_number(logfile):
-    with open(logfile) as f:
-        for line in f:
-            match = ENO_REGEX.match(line)
-            if match:
-                rheno = int(match.group(1))
-                lheno = int(match.group(2))
+
+# a regex per requested metric: a single regex alternating the patterns
+# would have no literal prefix to skip ahead to
+@functools.lru_cache()
+def compile_patterns(metrics):
+    return [(re.compile(x[2]),) + x[:2] + x[3:]
+            for x in LOG_PATTERNS if x[0] in metrics]
+
+
+# matches of a regex at the start of a line
+def _line_matches(regex, buffer):
+    for match in regex.finditer(buffer):
+        start = match.start()
+        if start == 0 or buffer[start - 1] == ord('\n'):
+            yield match
+
+
+def harvest_buffer(buffer, metrics=('euler',)):
+    values = {}
+    for regex, _, columns, occurrence, convert in compile_patterns(
+            tuple(metrics)):
+        match = None
+        for match in _line_matches(regex, buffer):
+            if occurrence == 'first':
                 break
-        else:
-            rheno = None
-            lheno = None
-    return rheno, lheno
+        for i, column in enumerate(columns, 1):
+            values[column] = convert(match.group(i)) if match else None
+    return values
+
+
+# scan the memory-mapped log file at once instead of decoding each line;
+# threads read the whole file instead, since f.read() releases the GIL
+# while page faults of a memory-mapped file happen within re
+def harvest_log(logfile, metrics=('euler',), use_mmap=True):
+    with open(logfile, 'rb') as f:
+        if not use_mmap:
+            return harvest_buffer(f.read(), metrics)
+        if os.fstat(f.fileno()).st_size == 0:  # cannot mmap an empty file
+            return harvest_buffer(b'', metrics)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return harvest_buffer(m, metrics)
+
+
+def extract_euler_number(logfile):
+    values = harvest_log(logfile)
+    return values['rheno'], values['lheno']
+
 
+# a missing, unreadable or malformed log file must not abort a cohort-wide
+# run
+def _harvest_log(logfile, metrics, use_mmap=True):
+    try:
+        return harvest_log(logfile, metrics, use_mmap)
+    except (OSError, ValueError) as e:
+        print('Cannot parse ' + logfile + ': ' + str(e), file=sys.stderr)
+        return {}
 
-# extracts the Euler numbers of the orig.nofix surfaces
-def extract_euler_numbers(subjects):
-    subjects_dir = os.environ['SUBJECTS_DIR']
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# reads the next log files in the background while the current one is
+# parsed, hiding network filesystem latency; at most depth files are held
+# in memory at any time, provided the caller drops each file before asking
+# for the next one: the next read starts only then
+def prefetch_logs(logfiles, depth):
+    logfiles = iter(logfiles)
+    with concurrent.futures.ThreadPoolExecutor(depth) as executor:
+        pending = collections.deque(
+            (logfile, executor.submit(_read_file, logfile))
+            for logfile in itertools.islice(logfiles, depth))
+        while pending:
+            yield pending.popleft()
+            for logfile in itertools.islice(logfiles, 1):
+                pending.append((logfile, executor.submit(_read_file, logfile)))
+
+
+def _harvest_prefetched(logfile, future, metrics):
+    try:
+        return harvest_buffer(future.result(), metrics)
+    except (OSError, ValueError) as e:
+        print('Cannot parse ' + logfile + ': ' + str(e), file=sys.stderr)
+        return {}
+
+
+# the cache maps each subject to [logfile, size, mtime, {column: value}]
+def load_cache(cachefile):
+    try:
+        with open(cachefile) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print('Ignoring cache ' + cachefile + ': ' + str(e), file=sys.stderr)
+        return {}
+
+
+def save_cache(cachefile, cache):
+    tmpfile = cachefile + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmpfile, cachefile)
+
+
+def _stat_logfile(logfile):
+    try:
+        st = os.stat(logfile)
+    except OSError:
+        return None
+    return [logfile, st.st_size, st.st_mtime_ns]
+
+
+def _cached_values(entry, stat, columns):
+    if stat and entry and len(entry) == 4 and entry[:3] == stat:
+        if all(column in entry[3] for column in columns):
+            return entry[3]
+    return None
+
+
+# extracts the Euler numbers of the orig.nofix surfaces and other metrics
+def harvest_logs(subjects, metrics=('euler',), jobs=1, cache=None,
+                 subjects_dir=None, prefetch=0):
+    if subjects_dir is None:
+        subjects_dir = os.environ['SUBJECTS_DIR']
     print('SUBJECTS_DIR : ' + subjects_dir)
-    print('Parsing the log files')
 
+    logfiles = {subject: os.path.join(subjects_dir, subject,
+                                      'scripts', 'recon-all.log')
+                for subject in subjects}
+    columns = [column for x in LOG_PATTERNS if x[0] in metrics
+               for column in x[1]]
+
+    # reuse cached values of log files that have not changed
     result = {}
-    for subject in subjects:
-        logfile_path = os.path.join(subjects_dir,
-                                    subject, 'scripts', 'recon-all.log')
-        result[subject] = extract_euler_number(logfile_path)
+    stats = {}
+    if cache is not None:
+        for subject in subjects:
+            stats[subject] = _stat_logfile(logfiles[subject])
+            values = _cached_values(cache.get(subject), stats[subject],
+                                    columns)
+            if values is not None:
+                result[subject] = values
+        print('Reusing {} cached subjects'.format(len(result)))
+
+    print('Parsing the log files')
+    todo = [subject for subject in subjects if subject not in result]
+    harvest = functools.partial(_harvest_log, metrics=tuple(metrics))
+    if jobs > 1:
+        # reading the log files is I/O bound, threads are enough
+        harvest = functools.partial(harvest, use_mmap=False)
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            values = list(executor.map(harvest,
+                                       (logfiles[subject] for subject in todo)))
+    elif prefetch > 0:
+        values = []
+        for logfile, future in prefetch_logs(
+                (logfiles[subject] for subject in todo), prefetch):
+            values.append(_harvest_prefetched(logfile, future, tuple(metrics)))
+            del future  # release the file before the next read
+    else:
+        values = [harvest(logfiles[subject]) for subject in todo]
+    result.update(zip(todo, values))
+
+    if cache is not None:
+        for subject, v in zip(todo, values):
+            if stats[subject] and v:
+                cache[subject] = stats[subject] + [v]
+            else:
+                cache.pop(subject, None)
     return result
 
 
+def extract_euler_numbers(subjects, jobs=1, cache=None, subjects_dir=None):
+    result = harvest_logs(subjects, ('euler',), jobs, cache, subjects_dir)
+    return {subject: (values.get('rheno'), values.get('lheno'))
+            for subject, values in result.items()}
+
+
+# subject IDs, column names and a float32 matrix that load without parsing
+def write_binary_table(tablefile, header, rows, binary='npz'):
+    import numpy as np
+
+    subjects = [row[0] for row in rows]
+    data = np.array([[np.nan if x is None or x == '' else float(x)
+                      for x in row[1:]] for row in rows],
+                    dtype=np.float32).reshape(len(rows), len(header) - 1)
+    if binary == 'npz':
+        np.savez(tablefile,
+                 subjects=np.array(subjects, dtype=str),
+                 columns=np.array(header[1:], dtype=str),
+                 data=data)
+    elif binary == 'arrow':
+        # an uncompressed Arrow IPC file can be memory-mapped
+        import pyarrow as pa
+        import pyarrow.feather as feather
+
+        columns = {header[0]: pa.array(subjects, type=pa.string())}
+        for i, name in enumerate(header[1:]):
+            columns[name] = pa.array(data[:, i])
+        feather.write_feather(pa.table(columns), tablefile,
+                              compression='uncompressed')
+    else:
+        raise ValueError('unknown binary format: ' + binary)
+
+
+def write_table(tablefile, header, rows, delimiter='\t', binary=None,
+                text_columns=()):
+    with open(tablefile, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile,
+                            delimiter=delimiter,
+                            quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(header)
+        writer.writerows(rows)
+    if binary:
+        # the binary copy only holds numeric columns
+        keep = [i for i, name in enumerate(header)
+                if i == 0 or name not in text_columns]
+        extensions = {x[0]: x[1] for x in BINARY_FORMAT}
+        write_binary_table(os.path.splitext(tablefile)[0] + extensions[binary],
+                           [header[i] for i in keep],
+                           [[row[i] for i in keep] for row in rows], binary)
+
+
+def _mean_euler_number(rh_eno, lh_eno):
+    if rh_eno and lh_eno:
+        mean_eno = rh_eno + lh_eno
+        if mean_eno % 2:
+            mean_eno /= 2
+        else:
+            mean_eno //= 2
+    else:
+        mean_eno = None
+    return mean_eno
+
+
+# one column per value extracted from the log files
+def write_log_table(tablefile, result, metrics=('euler',), delimiter='\t',
+                    binary=None):
+    patterns = [x for x in LOG_PATTERNS if x[0] in metrics]
+    header = ['orig.nofix']
+    text_columns = []
+    for metric, columns, _, _, convert in patterns:
+        header += columns
+        if metric == 'euler':
+            header.append('mean')
+        if convert is _decode:
+            text_columns += columns
+    rows = []
+    for subject in sorted(result.keys()):
+        values = result[subject]
+        row = [subject]
+        for metric, columns, _, _, _ in patterns:
+            row += [values.get(column) for column in columns]
+            if metric == 'euler':
+                row.append(_mean_euler_number(values.get('rheno'),
+                                              values.get('lheno')))
+        rows.append(row)
+    write_table(tablefile, header, rows, delimiter, binary, text_columns)
+
+
+def write_euler_table(tablefile, result, delimiter='\t', binary=None):
+    write_log_table(tablefile,
+                    {subject: dict(zip(('rheno', 'lheno'), eno))
+                     for subject, eno in result.items()},
+                    ('euler',), delimiter, binary)
+
+
+# a single directory read, without a stat per entry on most filesystems
+def discover_subjects(subjects_dir, pattern='*'):
+    with os.scandir(subjects_dir) as entries:
+        return sorted(entry.name for entry in entries
+                      if fnmatch.fnmatchcase(entry.name, pattern) and
+                      entry.is_dir())
+
+
+def add_subjects_arguments(parser):
+    parser.add_argument('--subjects-dir',
+                        default=os.environ.get('SUBJECTS_DIR'),
+                        help='FreeSurfer subjects directory '
+                             '(default: $SUBJECTS_DIR)')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-s', '--subjects',
+                       nargs='*',
+                       help='subject1 <subject2 subject3..>')
+    group.add_argument('-p', '--pattern',
+                       help='process subjects of the subjects directory '
+                            'matching this shell pattern')
+    group.add_argument('--subjects-from',
+                       metavar='FILE',
+                       type=argparse.FileType('r'),
+                       help='read subjects from a file, one per line, '
+                            'or from standard input if FILE is -')
+
+
+def get_subjects(parser, args):
+    if not args.subjects_dir:
+        parser.error('SUBJECTS_DIR is not set, use --subjects-dir')
+    if args.pattern:
+        return discover_subjects(args.subjects_dir, args.pattern)
+    elif args.subjects_from:
+        with args.subjects_from as f:
+            return [line.strip() for line in f if line.strip()]
+    return args.subjects
+
+
 def main(argv):
-    parser = argparse.ArgumentParser(description='Extract Euler numbers from FreeSurfer log files.')
-    parser.add_argument('-s', '--subjects',
-                        nargs='*',
-                        required=True,
-                        help='subject1 <subject2 subject3..>')
+    parser = argparse.ArgumentParser(description='Extract Euler numbers and other metrics from FreeSurfer log files.')
+    add_subjects_arguments(parser)
+    metric_args = [x[0] for x in LOG_PATTERNS]
+    parser.add_argument('-m', '--metrics',
+                        nargs='+',
+                        default=metric_args[:1],
+                        choices=metric_args,
+                        help='metrics to extract, each log file is read once')
     parser.add_argument('-t', '--tablefile',
                         required=True,
                         help='output table file')
@@ -89,28 +404,43 @@ def main(argv):
                         default=delimiter_args[0],
                         choices=delimiter_args,
                         help='delimiter between measures in the table')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of log files to parse concurrently')
+    parser.add_argument('--prefetch',
+                        metavar='K',
+                        type=int,
+                        default=0,
+                        help='read log files ahead while parsing the current '
+                             'one, holding at most K files in memory; '
+                             'ignored with --jobs')
+    parser.add_argument('-c', '--cache',
+                        action='store_true',
+                        help='only parse log files that changed since the '
+                             'previous run, using a cache next to the table')
+    binary_args, _ = zip(*BINARY_FORMAT)
+    parser.add_argument('-b', '--binary',
+                        choices=binary_args,
+                        help='also write a columnar binary copy of the table')
     args = parser.parse_args(argv[1:])
+    subjects = get_subjects(parser, args)
 
-    result = extract_euler_numbers(args.subjects)
+    if args.cache:
+        cachefile = args.tablefile + '.cache.json'
+        cache = load_cache(cachefile)
+        result = harvest_logs(subjects, args.metrics, args.jobs, cache,
+                              args.subjects_dir, args.prefetch)
+        save_cache(cachefile, cache)
+    else:
+        result = harvest_logs(subjects, args.metrics, args.jobs,
+                              subjects_dir=args.subjects_dir,
+                              prefetch=args.prefetch)
 
     print('Writing the table to ' + args.tablefile)
-    with open(args.tablefile, 'w', newline='') as csvfile:
-        delimiters = {x[0]: x[1] for x in DELIMITER}
-        writer = csv.writer(csvfile,
-                            delimiter=delimiters[args.delimiter],
-                            quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(('orig.nofix', 'rheno', 'lheno', 'mean'))
-        for subject in sorted(result.keys()):
-            rh_eno, lh_eno = result[subject]
-            if rh_eno and lh_eno:
-                mean_eno = rh_eno + lh_eno
-                if mean_eno % 2:
-                    mean_eno /= 2
-                else:
-                    mean_eno //= 2
-            else:
-                mean_eno = None
-            writer.writerow((subject, rh_eno, lh_eno, mean_eno))
+    delimiters = {x[0]: x[1] for x in DELIMITER}
+    write_log_table(args.tablefile, result, args.metrics,
+                    delimiters[args.delimiter], args.binary)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2019-2020 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# Create TSV tables with stats extracted from each individual dataset
+# processed by FreeSurfer, reading the stats files of each subject once
+# instead of running aparcstats2table and asegstats2table per measure.
+
+import argparse
+import concurrent.futures
+import functools
+import os
+import sys
+
+import eno2table
+
+HEMISPHERES = ('rh', 'lh')
+
+# aparcstats2table measure, column of ?h.aparc.stats, extra global measure
+APARC_MEASURES = [
+    ('area', 'SurfArea', 'WhiteSurfArea'),
+    ('volume', 'GrayVol', None),
+    ('thickness', 'ThickAvg', 'MeanThickness'),
+    ('thicknessstd', 'ThickStd', None),
+    ('meancurv', 'MeanCurv', None),
+    ('gauscurv', 'GausCurv', None),
+    ('foldind', 'FoldInd', None),
+    ('curvind', 'CurvInd', None),
+]
+
+# asegstats2table measure, column of aseg.stats
+ASEG_MEASURES = [
+    ('volume', 'Volume_mm3'),
+    ('mean', 'normMean'),
+]
+
+
+# parses a FreeSurfer stats file into its global measures and structures
+def read_stats(statsfile):
+    measures = {}
+    structures = []
+    colheaders = []
+    with open(statsfile) as f:
+        for line in f:
+            if line.startswith('# Measure '):
+                fields = [x.strip() for x in line[len('# Measure '):].split(',')]
+                measures[fields[1]] = fields[3]
+            elif line.startswith('# ColHeaders '):
+                colheaders = line.split()[2:]
+            elif not line.startswith('#'):
+                values = line.split()
+                if values:
+                    structures.append(dict(zip(colheaders, values)))
+    return measures, structures
+
+
+# a missing, unreadable or malformed file, e.g. a truncated line or bytes
+# that are not UTF-8, must not abort a cohort-wide run
+def _read(reader, path, default=None):
+    try:
+        return reader(path)
+    except (OSError, ValueError, IndexError) as e:
+        print('Cannot parse ' + path + ': ' + str(e), file=sys.stderr)
+        return default
+
+
+# reads all the stats and log files of a subject, once
+def read_subject(subjects_dir, subject):
+    path = os.path.join(subjects_dir, subject)
+    stats = {}
+    for hemi in HEMISPHERES:
+        stats[hemi] = _read(read_stats, os.path.join(path, 'stats',
+                                                     hemi + '.aparc.stats'))
+    stats['aseg'] = _read(read_stats,
+                          os.path.join(path, 'stats', 'aseg.stats'))
+    stats['euler'] = _read(eno2table.extract_euler_number,
+                           os.path.join(path, 'scripts', 'recon-all.log'),
+                           (None, None))
+    return stats
+
+
+def read_subjects(subjects_dir, subjects, jobs=1, executor=None):
+    reader = functools.partial(read_subject, subjects_dir)
+    if executor:
+        stats = list(executor.map(reader, subjects, chunksize=16))
+    elif jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            stats = list(executor.map(reader, subjects, chunksize=16))
+    else:
+        stats = [reader(subject) for subject in subjects]
+    return dict(zip(subjects, stats))
+
+
+# a table with one row per subject and one column per structure and measure
+def _table(result, key, structure_column, structure_format, measure_names):
+    header = {}
+    rows = []
+    for subject in sorted(result.keys()):
+        stats = result[subject][key]
+        row = {}
+        if stats:
+            measures, structures = stats
+            for structure in structures:
+                name = structure_format.format(structure['StructName'])
+                row[name] = structure.get(structure_column)
+            for measure, name in measure_names:
+                if measure in measures:
+                    row[name] = measures[measure]
+            header.update(dict.fromkeys(row))
+        rows.append((subject, row))
+    return list(header), [[subject] + [row.get(name) for name in header]
+                          for subject, row in rows]
+
+
+def aparc_table(result, hemi, meas):
+    _, column, extra = next(x for x in APARC_MEASURES if x[0] == meas)
+    measure_names = []
+    if extra:
+        measure_names.append((extra, hemi + '_' + extra + '_' + meas))
+    measure_names += [('BrainSegVolNotVent', 'BrainSegVolNotVent'),
+                      ('eTIV', 'eTIV')]
+    header, rows = _table(result, hemi, column,
+                          hemi + '_{}_' + meas, measure_names)
+    return [hemi + '.aparc.' + meas] + header, rows
+
+
+def aseg_table(result, meas):
+    column = dict(ASEG_MEASURES)[meas]
+    measure_names = []
+    if meas == 'volume':
+        for stats in result.values():
+            if stats['aseg']:
+                measure_names = [(x, 'EstimatedTotalIntraCranialVol'
+                                  if x == 'eTIV' else x)
+                                 for x in stats['aseg'][0]]
+                break
+    header, rows = _table(result, 'aseg', column, '{}', measure_names)
+    return ['Measure:' + meas] + header, rows
+
+
+# writes the aparc, aseg and Euler number tables in a single pass
+# pass an executor to share a worker pool between several calls
+def build_tables(subjects_dir, subjects, stats_dir, jobs=1, delimiter='\t',
+                 binary=None, executor=None):
+    print('SUBJECTS_DIR : ' + subjects_dir)
+    print('Parsing the stats and log files')
+    result = read_subjects(subjects_dir, subjects, jobs, executor)
+
+    print('Writing the tables to ' + stats_dir)
+    for meas, _, _ in APARC_MEASURES:
+        for hemi in HEMISPHERES:
+            header, rows = aparc_table(result, hemi, meas)
+            tablefile = os.path.join(stats_dir,
+                                     hemi + '.aparc.' + meas + '.tsv')
+            eno2table.write_table(tablefile, header, rows, delimiter, binary)
+    for meas, _ in ASEG_MEASURES:
+        header, rows = aseg_table(result, meas)
+        tablefile = os.path.join(stats_dir, 'aseg.' + meas + '.tsv')
+        eno2table.write_table(tablefile, header, rows, delimiter, binary)
+    eno2table.write_euler_table(
+        os.path.join(stats_dir, 'euler.tsv'),
+        {subject: stats['euler'] for subject, stats in result.items()},
+        delimiter, binary)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Create FreeSurfer stats tables in a single pass.')
+    eno2table.add_subjects_arguments(parser)
+    parser.add_argument('-o', '--stats-dir',
+                        required=True,
+                        help='output directory for the tables')
+    delimiter_args, _ = zip(*eno2table.DELIMITER)
+    parser.add_argument('-d', '--delimiter',
+                        default=delimiter_args[0],
+                        choices=delimiter_args,
+                        help='delimiter between measures in the table')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of subjects to parse concurrently')
+    binary_args, _ = zip(*eno2table.BINARY_FORMAT)
+    parser.add_argument('-b', '--binary',
+                        choices=binary_args,
+                        help='also write a columnar binary copy of the tables')
+    args = parser.parse_args(argv[1:])
+    subjects = eno2table.get_subjects(parser, args)
+
+    delimiters = {x[0]: x[1] for x in eno2table.DELIMITER}
+    build_tables(args.subjects_dir, subjects, args.stats_dir,
+                 args.jobs, delimiters[args.delimiter], args.binary)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2019-2020 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# Create the FreeSurfer stats tables of several timepoints concurrently,
+# sharing a single pool of workers between timepoints.
+
+import argparse
+import concurrent.futures
+import os
+import sys
+
+import eno2table
+import stats2table
+
+TIMEPOINTS = [
+    ('FU3',
+     '/neurospin/imagen/FU3/processed/freesurfer',
+     '/neurospin/imagen/FU3/processed/freesurfer_stats'),
+    ('STRATIFY',
+     '/neurospin/imagen/STRATIFY/processed/freesurfer',
+     '/neurospin/imagen/STRATIFY/processed/freesurfer_stats'),
+]
+
+
+def build_timepoints(timepoints, pattern='0000*', jobs=1, delimiter='\t',
+                     binary=None):
+    timepoints = [x for x in timepoints if os.path.isdir(x[1])]
+    if not timepoints:
+        return
+    # subjects of all timepoints are parsed by the same process pool while
+    # a thread per timepoint waits for its subjects and writes its tables
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor, \
+            concurrent.futures.ThreadPoolExecutor(len(timepoints)) as writers:
+        futures = {}
+        for timepoint, subjects_dir, stats_dir in timepoints:
+            subjects = eno2table.discover_subjects(subjects_dir, pattern)
+            print('{} : {} subjects'.format(timepoint, len(subjects)))
+            futures[timepoint] = writers.submit(
+                stats2table.build_tables, subjects_dir, subjects, stats_dir,
+                jobs, delimiter, binary, executor)
+        for timepoint, future in futures.items():
+            future.result()
+            print(timepoint + ' : done')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Create FreeSurfer stats tables of several timepoints concurrently.')
+    parser.add_argument('-t', '--timepoint',
+                        nargs=3,
+                        action='append',
+                        metavar=('NAME', 'SUBJECTS_DIR', 'STATS_DIR'),
+                        help='timepoint to process, may be repeated '
+                             '(default: ' +
+                             ', '.join(x[0] for x in TIMEPOINTS) + ')')
+    parser.add_argument('-p', '--pattern',
+                        default='0000*',
+                        help='process subjects matching this shell pattern')
+    delimiter_args, _ = zip(*eno2table.DELIMITER)
+    parser.add_argument('-d', '--delimiter',
+                        default=delimiter_args[0],
+                        choices=delimiter_args,
+                        help='delimiter between measures in the table')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of subjects to parse concurrently, '
+                             'across all timepoints')
+    binary_args, _ = zip(*eno2table.BINARY_FORMAT)
+    parser.add_argument('-b', '--binary',
+                        choices=binary_args,
+                        help='also write a columnar binary copy of the tables')
+    args = parser.parse_args(argv[1:])
+
+    delimiters = {x[0]: x[1] for x in eno2table.DELIMITER}
+    build_timepoints(args.timepoint or TIMEPOINTS, args.pattern, args.jobs,
+                     delimiters[args.delimiter], args.binary)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Benchmark restore.py on a synthetic DWI phantom with known tensors,
+# Rician noise and injected outliers, reporting the throughput and the
+# accuracy of each fit mode. No external data is needed.
+#
+# Usage: bench_restore.py [--shape X Y Z] [--directions N] [--b0 N]
+#                         [--bvalue B] [--snr SNR] [--outliers FRACTION]
+#                         [--jobs N] [--workdir DIR]
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import nibabel as nib
+import dipy.reconst.dti as dti
+import dipy.core.gradients as cg
+
+import restore
+
+# signal of the b=0 volumes in the brain
+S0 = 1000.0
+
+
+# gradient scheme like the IMAGEN acquisitions: a few b=0 volumes followed
+# by directions uniformly spread on the sphere at a single b-value
+def imagen_scheme(directions=32, b0=4, bvalue=1300):
+    # Fibonacci sphere, one direction per antipodal pair
+    i = np.arange(directions) + 0.5
+    z = 1 - i / directions
+    phi = np.pi * (1 + 5 ** 0.5) * i
+    r = np.sqrt(1 - z * z)
+    bvecs = np.vstack([np.zeros((b0, 3)),
+                       np.column_stack([r * np.cos(phi), r * np.sin(phi), z])])
+    bvals = np.concatenate([np.zeros(b0), np.full(directions, bvalue)])
+    return bvals, bvecs
+
+
+# ellipsoid brain of random prolate tensors with white matter like
+# diffusivities, Rician noise everywhere and a fraction of brain voxels
+# with one diffusion weighted volume corrupted by signal dropout
+def phantom(shape, bvals, bvecs, snr=20, outliers=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    grid = np.indices(shape, dtype=np.float64)
+    centre = (np.array(shape, dtype=np.float64) - 1) / 2
+    radius = 0.45 * np.array(shape, dtype=np.float64)
+    mask = sum(((g - c) / r) ** 2
+               for g, c, r in zip(grid, centre, radius)) <= 1
+    n = np.count_nonzero(mask)
+
+    evals = np.column_stack([rng.uniform(1.2e-3, 1.8e-3, n),
+                             rng.uniform(0.2e-3, 0.6e-3, n),
+                             rng.uniform(0.1e-3, 0.4e-3, n)])
+    evals = -np.sort(-evals, axis=1)
+    evecs, _ = np.linalg.qr(rng.normal(size=(n, 3, 3)))
+    tensors = np.einsum('vij,vj,vkj->vik', evecs, evals, evecs)
+    signal = S0 * np.exp(-bvals * np.einsum('gi,vij,gj->vg',
+                                            bvecs, tensors, bvecs))
+
+    sigma = S0 / snr
+    data = np.zeros(shape + (len(bvals),))
+    data[mask] = signal
+    data = np.abs(data + rng.normal(0, sigma, data.shape) +
+                  1j * rng.normal(0, sigma, data.shape))
+    dwi = np.flatnonzero(bvals > 0)
+    corrupted = np.flatnonzero(rng.random(n) < outliers)
+    brain = data[mask]
+    brain[corrupted, rng.choice(dwi, len(corrupted))] *= 0.3
+    data[mask] = brain
+    return data.astype(np.float32), mask, evals, sigma
+
+
+def _timed(function, *args, **kwargs):
+    # restore.py reports progress on standard output
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return time.perf_counter() - start, result
+
+
+def _accuracy(evals, true_evals):
+    fa = dti.fractional_anisotropy(evals)
+    true_fa = dti.fractional_anisotropy(true_evals)
+    md = evals.mean(axis=1)
+    true_md = true_evals.mean(axis=1)
+    return (np.median(np.abs(fa - true_fa)),
+            np.median(np.abs(md - true_md) / true_md))
+
+
+# fit of the brain voxels by each mode, in memory
+def benchmark_fits(gtab, voxels, true_evals, sigma, jobs):
+    wls = dti.TensorModel(gtab, fit_method='WLS')
+    robust = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
+    modes = [
+        ('WLS', lambda: restore.fit_tensor(wls, voxels)),
+        ('RESTORE', lambda: restore.fit_tensor(robust, voxels)),
+        ('two-phase', lambda: restore.fit_tensor_two_phase(robust, voxels,
+                                                            sigma)),
+    ]
+    if jobs > 1:
+        modes += [
+            ('RESTORE jobs={}'.format(jobs),
+             lambda: restore.fit_tensor(robust, voxels, jobs)),
+            ('two-phase jobs={}'.format(jobs),
+             lambda: restore.fit_tensor_two_phase(robust, voxels, sigma,
+                                                  jobs)),
+        ]
+    results = []
+    for mode, fit in modes:
+        t, (evals, _) = _timed(fit)
+        results.append((mode, len(voxels), t) + _accuracy(evals, true_evals))
+    return results
+
+
+# whole restore.py pipeline from NIfTI files, with and without a mask
+def benchmark_pipeline(workdir, data, mask, bvals, bvecs, jobs):
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    files = {}
+    for name, image in (('dwi', data), ('mask', mask.astype(np.uint8))):
+        files[name] = os.path.join(workdir, name + '.nii.gz')
+        nib.save(nib.Nifti1Image(image, affine), files[name])
+    files['bval'] = os.path.join(workdir, 'dwi.bval')
+    files['bvec'] = os.path.join(workdir, 'dwi.bvec')
+    np.savetxt(files['bval'], bvals[None], fmt='%d')
+    np.savetxt(files['bvec'], bvecs.T, fmt='%.6f')
+    output = os.path.join(workdir, 'dwi')
+    arguments = (files['dwi'], files['dwi'], files['bval'], files['bvec'],
+                 output)
+
+    results = []
+    for mode, maskfile, voxels in (('pipeline', None, mask.size),
+                                   ('pipeline --mask', files['mask'],
+                                    np.count_nonzero(mask))):
+        t, _ = _timed(restore.process_subject, *arguments, maskfile=maskfile,
+                      jobs=jobs)
+        results.append((mode, voxels, t, np.nan, np.nan))
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark restore.py on a synthetic DWI phantom.')
+    parser.add_argument('--shape',
+                        type=int,
+                        nargs=3,
+                        default=[40, 40, 20],
+                        metavar=('X', 'Y', 'Z'),
+                        help='size of the phantom volume')
+    parser.add_argument('--directions',
+                        type=int,
+                        default=32,
+                        help='number of diffusion directions')
+    parser.add_argument('--b0',
+                        type=int,
+                        default=4,
+                        help='number of b=0 volumes')
+    parser.add_argument('--bvalue',
+                        type=float,
+                        default=1300,
+                        help='b-value of the diffusion weighted volumes')
+    parser.add_argument('--snr',
+                        type=float,
+                        default=20,
+                        help='signal to noise ratio of the b=0 volumes')
+    parser.add_argument('--outliers',
+                        type=float,
+                        default=0.1,
+                        help='fraction of brain voxels with a corrupted volume')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of processes of the parallel modes')
+    parser.add_argument('--workdir',
+                        help='where to write the phantom images for the '
+                             'pipeline modes (default: a temporary '
+                             'directory, removed afterwards)')
+    args = parser.parse_args(argv[1:])
+
+    bvals, bvecs = imagen_scheme(args.directions, args.b0, args.bvalue)
+    gtab = cg.gradient_table(bvals, bvecs=bvecs)
+    data, mask, true_evals, sigma = phantom(tuple(args.shape), bvals, bvecs,
+                                            args.snr, args.outliers)
+    print('Phantom of {} voxels, {} in the brain, {} volumes'.format(
+        mask.size, np.count_nonzero(mask), len(bvals)))
+
+    results = benchmark_fits(gtab, data[mask], true_evals, sigma, args.jobs)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_restore_')
+    try:
+        os.makedirs(workdir, exist_ok=True)
+        results += benchmark_pipeline(workdir, data, mask, bvals, bvecs,
+                                      args.jobs)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    print('{:>18} {:>8} {:>10} {:>10} {:>8} {:>8}'.format(
+        'mode', 'voxels', 'seconds', 'voxels/s', 'FA err', 'MD err'))
+    for mode, voxels, t, fa_error, md_error in results:
+        print('{:>18} {:>8} {:>10.3f} {:>10.0f} {:>8.4f} {:>8.4f}'.format(
+            mode, voxels, t, voxels / t if t else float('inf'),
+            fa_error, md_error))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
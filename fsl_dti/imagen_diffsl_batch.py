@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# Run imagen_diffsl on the subjects of a manifest in a pool of workers,
+# skipping the subjects already processed.
+#
+# Usage: imagen_diffsl_batch.py [options] manifest pdir
+#
+# manifest = file with a row "mag phase dti center" per subject, with the
+#            arguments of imagen_diffsl, e.g. "NA phase dti 2"
+# pdir     = processing directory, as imagen_diffsl
+# --jobs   = number of subjects processed in parallel
+# --restore = yes or no, as imagen_diffsl
+# --log-dir = directory of the logs of each subject, by default pdir/logs
+# --force  = process all subjects, even those already processed
+#
+# A subject is processed if its final FA map exists and is newer than its
+# input files, and its log ends with the final message of imagen_diffsl.
+# The final FA map is after distortion correction, unless the subject has
+# no field map, as decided by imagen_diffsl.
+
+import argparse
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import sys
+
+IMAGE_EXTENSIONS = ['.nii.gz', '.nii', '.hdr', '.img', '.hdr.gz', '.img.gz']
+
+# last message of imagen_diffsl for a complete run
+DONE = 'Process for subject {} done'
+
+
+# manifest rows: mag phase dti center
+def read_manifest(manifest):
+    rows = []
+    with open(manifest) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                if len(fields) != 4:
+                    raise ValueError('invalid manifest row: ' + line.strip())
+                rows.append(fields)
+    return rows
+
+
+# images may be given with or without extension, as with FSL remove_ext
+def _remove_ext(path):
+    for extension in IMAGE_EXTENSIONS:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+
+# the subject identifier, as computed by imagen_diffsl from the dti
+# file, or from the first dti file for center 4
+def subject_id(row):
+    mag, phase, dti, center = row
+    image = mag if center == '4' else dti
+    return os.path.basename(_remove_ext(image)).split('_')[0]
+
+
+# existing input files of a subject, images with their bval/bvec files
+def input_files(row):
+    files = []
+    for image in row[:3]:
+        image = _remove_ext(image)
+        for extension in IMAGE_EXTENSIONS + ['.bval', '.bvec']:
+            if os.path.isfile(image + extension):
+                files.append(image + extension)
+    return files
+
+
+# an image exists under any extension, as FSL imtest
+def _image_exists(image):
+    image = _remove_ext(image)
+    return any(os.path.isfile(image + x) for x in IMAGE_EXTENSIONS)
+
+
+# imagen_diffsl corrects distortions with the field map, except for
+# center 4, or if the phase image is missing, or the magnitude image for
+# centers other than 2 and 3 whose magnitude is derived from the phase
+def distortion_corrected(row):
+    mag, phase, _, center = row
+    if center == '4' or not _image_exists(phase):
+        return False
+    return center in ('2', '3') or _image_exists(mag)
+
+
+# FA map of the last tensor computation of imagen_diffsl for a subject,
+# the FA map before distortion correction is not a final output
+def final_fa(pdir, row, restore):
+    subject = subject_id(row)
+    if distortion_corrected(row):
+        stem = '_dti_ecc_dc_brain'
+    else:
+        stem = '_dti_ecc_brain'
+    suffix = '_restore_FA' if restore == 'yes' else '_FA'
+    path = os.path.join(pdir, subject, subject + stem + suffix)
+    for extension in IMAGE_EXTENSIONS:
+        if os.path.isfile(path + extension):
+            return path + extension
+    return None
+
+
+# without a log, there is no evidence that a run was not interrupted
+def _log_complete(logfile, subject):
+    try:
+        with open(logfile, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 4096))
+            return DONE.format(subject).encode() in f.read()
+    except FileNotFoundError:
+        return False
+
+
+def is_done(row, pdir, restore, logfile):
+    subject = subject_id(row)
+    fa = final_fa(pdir, row, restore)
+    if fa is None or not _log_complete(logfile, subject):
+        return False
+    mtime = os.stat(fa).st_mtime
+    return all(os.stat(x).st_mtime < mtime for x in input_files(row))
+
+
+# imagen_diffsl changes directory before reading its inputs and writing
+# to pdir, relative paths must be made absolute; NA is a missing input
+def absolute_row(row):
+    return [x if x == 'NA' else os.path.abspath(x) for x in row[:3]] + row[3:]
+
+
+def run_subject(imagen_diffsl, row, pdir, restore, logfile):
+    with open(logfile, 'w') as log:
+        process = subprocess.run([imagen_diffsl] + row + [restore, pdir],
+                                 stdout=log, stderr=subprocess.STDOUT)
+    return process.returncode
+
+
+# imagen_diffsl exits with status 0 even if an input file is missing, the
+# outputs tell whether a subject has been processed
+def run_batch(imagen_diffsl, rows, pdir, restore='yes', jobs=1, log_dir=None,
+              force=False):
+    pdir = os.path.abspath(pdir)
+    rows = [absolute_row(row) for row in rows]
+    log_dir = log_dir or os.path.join(pdir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    logfiles = {}
+    todo = []
+    for row in rows:
+        subject = subject_id(row)
+        logfiles[subject] = os.path.join(log_dir, subject + '.log')
+        if not force and is_done(row, pdir, restore, logfiles[subject]):
+            print(subject + ' : already processed')
+        else:
+            todo.append(row)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(run_subject, imagen_diffsl, row, pdir,
+                                   restore, logfiles[subject_id(row)]): row
+                   for row in todo}
+        for future in concurrent.futures.as_completed(futures):
+            row = futures[future]
+            subject = subject_id(row)
+            if future.result() == 0 and is_done(row, pdir, restore,
+                                                logfiles[subject]):
+                print(subject + ' : done')
+            else:
+                print(subject + ' : failed, see ' + logfiles[subject],
+                      file=sys.stderr)
+                failed.append(subject)
+    return failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run imagen_diffsl on several subjects in parallel.')
+    parser.add_argument('manifest',
+                        help='file with a row "mag phase dti center" '
+                             'per subject')
+    parser.add_argument('pdir', help='processing directory')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of subjects processed in parallel')
+    parser.add_argument('--restore',
+                        default='yes',
+                        choices=['yes', 'no'],
+                        help='tensor computation with RESTORE '
+                             '(default: %(default)s)')
+    parser.add_argument('--log-dir',
+                        help='directory of the subject logs '
+                             '(default: pdir/logs)')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='process subjects already processed')
+    parser.add_argument('--imagen-diffsl',
+                        default=os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), 'imagen_diffsl'),
+                        help='imagen_diffsl script '
+                             '(default: next to this script)')
+    args = parser.parse_args(argv[1:])
+
+    imagen_diffsl = args.imagen_diffsl
+    if not os.path.isfile(imagen_diffsl):
+        imagen_diffsl = shutil.which('imagen_diffsl')
+        if not imagen_diffsl:
+            parser.error('cannot find imagen_diffsl')
+    failed = run_batch(imagen_diffsl, read_manifest(args.manifest),
+                       args.pdir, args.restore, args.jobs, args.log_dir,
+                       args.force)
+    if failed:
+        sys.exit('{} subjects failed'.format(len(failed)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
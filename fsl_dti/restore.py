@@ -1,27 +1,45 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 # Using the RESTORE algorithm for robust tensor fitting
 # http://nipy.org/dipy/examples_built/restore_dti.html
-# 
+#
 # 09/17/2015 H. Lemaitre (herve.lemaitre@u-psud.fr).
-# Usage: restore.py rawfile dtifile dtibval dtibvec output
+# Usage: restore.py [options] rawfile dtifile dtibval dtibvec output
+#        restore.py [options] --manifest manifest
 #
 # rawfile = diffusion weighted image non masked
 # dtifile = diffusion weighted masked
 # dtibval = bval file
 # dtibvec = bvec file
 # output  = output name
+# --jobs  = number of processes fitting blocks of voxels in parallel
+# --mask  = brain mask, by default the non-zero b=0 voxels of dtifile
+# --compression = gzip level of the outputs, 0 for uncompressed .nii files
+# --manifest = file with a row "rawfile dtifile dtibval dtibvec output [maskfile]"
+#              per subject, all processed in a single run
+# --two-phase = WLS fit of all voxels, RESTORE fit of the voxels with outliers
+# --timing = write the time and memory used by each stage to a JSON file
+# --checkpoint-dir = save the fit of each slab of slices, resume from them
+# --cache-dir = cache of the gradient tables and fit matrices per scheme
+# --output-format = maps (L1-L3, V1-V3, FA, MD, RD, MO), tensor (a single
+#                   symmetric tensor image read with tensor_store.py) or both
 #
 
-# arguments
-import sys
-rawfile=str(sys.argv[1])
-dtifile=str(sys.argv[2])
-dtibval=str(sys.argv[3])
-dtibvec=str(sys.argv[4])
-output=str(sys.argv[5])
-
 # imports
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import gzip
+import hashlib
+import json
+import os
+import resource
+import time
+import sys
+import uuid
+import zipfile
+from multiprocessing import shared_memory
 import numpy as np
 import nibabel as nib
 import dipy.reconst.dti as dti
@@ -29,69 +47,643 @@ import dipy.denoise.noise_estimate as ne
 import dipy.io as io
 import dipy.core.gradients as cg
 
-# load dti data
-raw=nib.load(rawfile)
-dataraw=raw.get_data()
-img = nib.load(dtifile)
-data = img.get_data()
+import tensor_store
+
+# number of voxels fitted by each task of the process pool
+BLOCK_SIZE = 1000
+
+# number of voxels per chunk when computing the scalar maps
+SCALAR_CHUNK_SIZE = 65536
+
+# number of slices along the first axis fitted between checkpoints
+SLAB_SIZE = 8
+
+# output images of each output format
+OUTPUT_FORMATS = ['maps', 'tensor', 'both']
+
+# gzip compression level of the output images, as nibabel
+COMPRESSLEVEL = 1
+
+# voxels and tensor model shared by the worker processes
+_worker = {}
+
+
+def _init_worker(name, shape, dtype, tenmodel):
+    _worker['shm'] = shared_memory.SharedMemory(name=name)
+    _worker['voxels'] = np.ndarray(shape, dtype=dtype,
+                                   buffer=_worker['shm'].buf)
+    _worker['tenmodel'] = tenmodel
+
+
+def _fit_block(rows):
+    tenfit = _worker['tenmodel'].fit(_worker['voxels'][rows])
+    return tenfit.evals, tenfit.evecs
+
+
+def _packed(evals, evecs):
+    evals = np.nan_to_num(np.asarray(evals, dtype=np.float32), copy=False)
+    evecs = np.nan_to_num(np.asarray(evecs, dtype=np.float32), copy=False)
+    return evals, evecs
+
+
+# tensor fitting of rows of a (voxels x gradients) array; with jobs > 1,
+# blocks of rows are fitted by a pool of processes reading the array from
+# shared memory, both created once for all the fits of parts of the array
+class VoxelFitter:
+
+    def __init__(self, tenmodel, voxels, jobs=1, block_size=BLOCK_SIZE):
+        self.tenmodel = tenmodel
+        self.voxels = voxels
+        self.block_size = block_size
+        self.shm = None
+        self.executor = None
+        if jobs > 1 and len(voxels) > 0:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=voxels.nbytes)
+            shared = np.ndarray(voxels.shape, dtype=voxels.dtype,
+                                buffer=self.shm.buf)
+            shared[:] = voxels
+            del shared
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=_init_worker,
+                initargs=(self.shm.name, voxels.shape, voxels.dtype,
+                          tenmodel))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        if self.shm:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def _blocks(self, rows):
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(len(self.voxels))
+            return [slice(i, min(i + self.block_size, stop))
+                    for i in range(start, stop, self.block_size)]
+        return [rows[i:i + self.block_size]
+                for i in range(0, len(rows), self.block_size)]
+
+    # start fitting rows, a slice or an array of indices, and return a
+    # function waiting for their eigenvalues and eigenvectors
+    def submit(self, rows=slice(None)):
+        blocks = self._blocks(rows)
+        if not blocks:
+            return lambda: (np.zeros((0, 3), dtype=np.float32),
+                            np.zeros((0, 3, 3), dtype=np.float32))
+        if self.executor is None:
+            def result():
+                tenfit = self.tenmodel.fit(self.voxels[rows])
+                return _packed(tenfit.evals, tenfit.evecs)
+            return result
+        futures = [self.executor.submit(_fit_block, block)
+                   for block in blocks]
+
+        def result():
+            fits = [future.result() for future in futures]
+            return _packed(np.concatenate([x[0] for x in fits]),
+                           np.concatenate([x[1] for x in fits]))
+        return result
+
+    def fit(self, rows=slice(None)):
+        return self.submit(rows)()
+
+
+# tensor fitting of the brain voxels only, packed into a compact
+# (voxels x gradients) array
+def fit_tensor(tenmodel, voxels, jobs=1):
+    with VoxelFitter(tenmodel, voxels, jobs) as fitter:
+        return fitter.fit()
+
+
+# weighted least squares fit of the log signal of a (voxels x gradients)
+# array, vectorized over chunks of voxels; returns the tensor parameters
+# in the layout of dti.design_matrix and the residuals of the signal
+def wls_fit(design, voxels, pinv=None, chunk_size=SCALAR_CHUNK_SIZE):
+    if pinv is None:
+        pinv = np.linalg.pinv(design)
+    params = np.empty((len(voxels), design.shape[1]))
+    residuals = np.empty(voxels.shape, dtype=np.float32)
+    positive = voxels[voxels > 0]
+    min_signal = positive.min() if positive.size else 1.0
+    for start in range(0, len(voxels), chunk_size):
+        signal = voxels[start:start + chunk_size].astype(np.float64)
+        log_signal = np.log(np.maximum(signal, min_signal))
+        # ordinary least squares estimate of the weights
+        weights = np.exp(log_signal @ pinv.T @ design.T) ** 2
+        normal = np.einsum('gi,vg,gj->vij', design, weights, design)
+        rhs = np.einsum('gi,vg,vg->vi', design, weights, log_signal)
+        try:
+            beta = np.linalg.solve(normal, rhs[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            beta = np.stack([np.linalg.lstsq(a, b, rcond=None)[0]
+                             for a, b in zip(normal, rhs)])
+        params[start:start + len(signal)] = beta
+        with np.errstate(over='ignore', invalid='ignore'):
+            residuals[start:start + len(signal)] = (
+                signal - np.exp(beta @ design.T))
+    return params, residuals
+
+
+# fast WLS fit of rows of the voxels, then RESTORE fit of the voxels with
+# outliers only, i.e. residuals above 3 sigma as the RESTORE criterion;
+# returns a function waiting for the RESTORE fits
+def submit_two_phase(fitter, rows, sigma, pinv=None):
+    voxels = fitter.voxels[rows]
+    params, residuals = wls_fit(fitter.tenmodel.design_matrix, voxels, pinv)
+    evals, evecs = _packed(*dti.decompose_tensor(
+        dti.from_lower_triangular(params[:, :6])))
+    outliers = ~np.all(np.abs(residuals) <= 3 * sigma, axis=-1)
+    indices = np.arange(len(fitter.voxels))[rows][outliers]
+    robust = fitter.submit(indices)
+
+    def result():
+        evals[outliers], evecs[outliers] = robust()
+        print('RESTORE iterations on {} of {} voxels'.format(
+            len(indices), len(voxels)))
+        return evals, evecs
+    return result
+
+
+def fit_tensor_two_phase(tenmodel, voxels, sigma, jobs=1, pinv=None):
+    with VoxelFitter(tenmodel, voxels, jobs) as fitter:
+        return submit_two_phase(fitter, slice(None), sigma, pinv)()
+
+
+# identifies the input of a fit, so that checkpoints of another subject or
+# of other settings are never reused
+def fingerprint(voxels, mask, gtab, sigma, two_phase):
+    sha1 = hashlib.sha1()
+    for array in (voxels, mask, gtab.bvals, gtab.bvecs):
+        sha1.update(np.ascontiguousarray(array).tobytes())
+    sha1.update(repr((mask.shape, float(sigma), two_phase)).encode())
+    return sha1.hexdigest()
+
+
+# slabs are named after the input fingerprint, so that runs on different
+# inputs can share a checkpoint directory
+def _slab_file(checkpoint_dir, key, start, stop):
+    return os.path.join(checkpoint_dir, 'slab_{}_{:04d}_{:04d}.npz'.format(
+        key[:16], start, stop))
+
+
+def _load_slab(path, key):
+    try:
+        with np.load(path) as slab:
+            if str(slab['fingerprint']) == key:
+                return slab['evals'], slab['evecs']
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        pass
+    return None
+
+
+# atomic write of a .npz file through a temporary file of a unique name,
+# since processes on several hosts may write the same file at once; unlike
+# tempfile.mkstemp, the file is readable by others as allowed by the umask
+def _save_npz(path, **arrays):
+    tmpfile = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    try:
+        with open(tmpfile, 'xb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmpfile, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmpfile)
+        raise
+
+
+def _save_slab(path, key, evals, evecs):
+    _save_npz(path, fingerprint=key, evals=evals, evecs=evecs)
+
+
+# fit the brain voxels by slabs of slices along the first axis, saving the
+# eigenvalues and eigenvectors of each slab to the checkpoint directory;
+# slabs already saved by an interrupted run with the same input are skipped
+# and the other slabs are all submitted at once to keep the workers busy
+def fit_slabs(submit, mask, checkpoint_dir, key, slab_size=SLAB_SIZE):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    counts = np.count_nonzero(mask.reshape(mask.shape[0], -1), axis=1)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    evals = np.empty((offsets[-1], 3), dtype=np.float32)
+    evecs = np.empty((offsets[-1], 3, 3), dtype=np.float32)
+    slabs = []
+    for start in range(0, mask.shape[0], slab_size):
+        stop = min(start + slab_size, mask.shape[0])
+        first, last = offsets[start], offsets[stop]
+        if first == last:
+            continue
+        path = _slab_file(checkpoint_dir, key, start, stop)
+        slab = _load_slab(path, key)
+        if slab is None:
+            slabs.append((path, first, last, submit(slice(first, last))))
+        else:
+            print('Reusing checkpoint ' + path)
+            evals[first:last], evecs[first:last] = slab
+            slabs.append((path, first, last, None))
+    for path, first, last, result in slabs:
+        if result is not None:
+            slab = result()
+            _save_slab(path, key, *slab)
+            evals[first:last], evecs[first:last] = slab
+    return evals, evecs, [slab[0] for slab in slabs]
+
+
+# put back the values of the brain voxels into a volume, background at 0
+def unpack(values, mask):
+    volume = np.zeros(mask.shape + values.shape[1:], dtype=np.float32)
+    volume[mask] = values
+    return volume
+
+
+# FA, MD, AD, RD and mode of the brain voxels computed from their sorted
+# eigenvalues in one pass over chunks of voxels, written directly into
+# float32 volumes, undefined values set to 0
+def scalar_maps(evals, mask, chunk_size=SCALAR_CHUNK_SIZE):
+    maps = {name: np.zeros(mask.shape, dtype=np.float32)
+            for name in ('FA', 'MD', 'AD', 'RD', 'MO')}
+    packed = {name: np.empty(len(evals), dtype=np.float32) for name in maps}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for start in range(0, len(evals), chunk_size):
+            stop = start + chunk_size
+            l1, l2, l3 = evals[start:stop].T
+            md = (l1 + l2 + l3) / 3
+            d1, d2, d3 = l1 - md, l2 - md, l3 - md
+            norm2 = d1 * d1 + d2 * d2 + d3 * d3
+            fa = np.sqrt(1.5 * norm2 / (l1 * l1 + l2 * l2 + l3 * l3))
+            mo = 3 * np.sqrt(6) * d1 * d2 * d3 / (norm2 * np.sqrt(norm2))
+            packed['FA'][start:stop] = np.nan_to_num(fa)
+            packed['MD'][start:stop] = md
+            packed['AD'][start:stop] = l1
+            packed['RD'][start:stop] = (l2 + l3) / 2
+            packed['MO'][start:stop] = np.clip(np.nan_to_num(mo), -1, 1)
+    for name, volume in maps.items():
+        volume[mask] = packed[name]
+    return maps
+
+
+# keep compressed images open so that reading them one volume at a time
+# does not decompress them again from the start for each volume
+def load_image(path):
+    return nib.load(path, keep_file_open=True)
+
+
+# read some volumes of a 4D image through its data proxy, without
+# loading the whole image in memory
+def load_volumes(img, volumes):
+    return np.stack([np.asarray(img.dataobj[..., i], dtype=np.float32)
+                     for i in volumes], axis=-1)
+
+
+# read the brain voxels of a 4D image one volume at a time into a
+# compact float32 (voxels x gradients) array
+def load_voxels(img, mask):
+    voxels = np.empty((np.count_nonzero(mask), img.shape[-1]),
+                      dtype=np.float32)
+    for i in range(img.shape[-1]):
+        voxels[:, i] = np.asanyarray(img.dataobj[..., i])[mask]
+    return voxels
+
+
+# an image is a pair of a suffix and either an array or a NIfTI image
+def _save_image(image, affine, prefix, compresslevel):
+    suffix, data = image
+    if isinstance(data, nib.Nifti1Image):
+        img = data
+    else:
+        img = nib.Nifti1Image(data, affine)
+    if compresslevel == 0:
+        nib.save(img, prefix + suffix + '.nii')
+    else:
+        with gzip.open(prefix + suffix + '.nii.gz', 'wb',
+                       compresslevel=compresslevel) as f:
+            img.to_file_map({'image': nib.FileHolder(fileobj=f)})
+
+
+# write the output images, compressing them in a pool of threads since
+# zlib releases the GIL; compression level 0 writes uncompressed images
+def save_images(images, affine, prefix, compresslevel=COMPRESSLEVEL, jobs=1):
+    save = functools.partial(_save_image, affine=affine, prefix=prefix,
+                             compresslevel=compresslevel)
+    if jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            list(executor.map(save, images))
+    else:
+        for image in images:
+            save(image)
+
+
+# gradient table and pseudo-inverse of the design matrix of the WLS fit,
+# identical for all the subjects acquired with the same gradient scheme
+def gradient_scheme(bvals, bvecs):
+    gtab = cg.gradient_table(bvals, bvecs=bvecs)
+    return gtab, np.linalg.pinv(dti.design_matrix(gtab))
+
+
+def _load_scheme(path):
+    try:
+        with np.load(path) as cache:
+            gtab = cg.gradient_table(cache['bvals'], bvecs=cache['bvecs'])
+            return gtab, cache['pinv']
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return None
+
+
+# the cache is an optimization, failing to write it does not fail a subject
+def _save_scheme(path, gtab, pinv):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _save_npz(path, bvals=gtab.bvals, bvecs=gtab.bvecs, pinv=pinv)
+    except OSError as e:
+        print('Cannot cache ' + path + ': ' + str(e), file=sys.stderr)
+
+
+# gradient schemes read from bval/bvec files, keyed by a hash of their
+# contents, reused by the subjects of a batch sharing the same scheme and
+# by later runs if they are cached in cache_dir
+def load_gradient_table(dtibval, dtibvec, gtabs=None, cache_dir=None):
+    with open(dtibval, 'rb') as f:
+        key = f.read()
+    with open(dtibvec, 'rb') as f:
+        key = hashlib.sha1(key + b'\0' + f.read()).hexdigest()
+    if gtabs is not None and key in gtabs:
+        return gtabs[key]
+    scheme = None
+    if cache_dir:
+        path = os.path.join(cache_dir, 'gradients_' + key + '.npz')
+        scheme = _load_scheme(path)
+    if scheme is None:
+        bvals, bvecs = io.read_bvals_bvecs(dtibval, dtibvec)
+        scheme = gradient_scheme(bvals, bvecs)
+        if cache_dir:
+            _save_scheme(path, *scheme)
+    if gtabs is not None:
+        gtabs[key] = scheme
+    return scheme
+
+
+def process_subject(rawfile, dtifile, dtibval, dtibvec, output, maskfile=None,
+                    jobs=1, compression=COMPRESSLEVEL, gtabs=None,
+                    two_phase=False, timing=False, checkpoint_dir=None,
+                    cache_dir=None, output_format='maps'):
+    timer = StageTimer()
+
+    with timer.stage('gradients'):
+        # load dti data, images are read on demand through their data proxy
+        raw = load_image(rawfile)
+        img = load_image(dtifile)
+
+        # load bvec and bvals
+        gtab, pinv = load_gradient_table(dtibval, dtibvec, gtabs, cache_dir)
+        b0 = np.flatnonzero(gtab.bvals == 0)
+
+    with timer.stage('sigma'):
+        # noise estimation from the b=0 volumes of the raw data only
+        sigma = ne.estimate_sigma(load_volumes(raw, b0))
+        sigmamean=np.mean(sigma)
+
+    with timer.stage('load'):
+        # brain mask
+        if maskfile:
+            mask = np.asanyarray(nib.load(maskfile).dataobj) > 0
+        else:
+            mask = np.any(load_volumes(img, b0) != 0, axis=-1)
+        voxels = load_voxels(img, mask)
+        # exclude voxels without signal that cannot be fitted
+        signal = np.any(voxels != 0, axis=-1)
+        if not signal.all():
+            mask[mask] = signal
+            voxels = voxels[signal]
+
+    with timer.stage('fit'):
+        # tensor computation using restore
+        tenmodel=dti.TensorModel(gtab,fit_method='RESTORE', sigma=sigmamean)
+        with VoxelFitter(tenmodel, voxels, jobs) as fitter:
+            if two_phase:
+                submit = functools.partial(submit_two_phase, fitter,
+                                           sigma=sigmamean, pinv=pinv)
+            else:
+                submit = fitter.submit
+            if checkpoint_dir:
+                key = fingerprint(voxels, mask, gtab, sigmamean, two_phase)
+                evals, evecs, slabs = fit_slabs(submit, mask, checkpoint_dir,
+                                                key)
+            else:
+                evals, evecs = submit(slice(None))()
+
+    with timer.stage('scalars'):
+        images = []
+        if output_format in ('tensor', 'both'):
+            # the 6 tensor elements, maps are derived by tensor_store
+            tensor = unpack(tensor_store.pack_tensor(evals, evecs), mask)
+            images.append(('tensor',
+                           tensor_store.tensor_image(tensor, img.affine)))
+        if output_format in ('maps', 'both'):
+            # Derivated measures
+            maps = scalar_maps(evals, mask)
+
+            evals = unpack(evals, mask)
+            evecs = unpack(evecs, mask)
+            images += [
+                ('L1', evals[:,:,:,0]),
+                ('L2', evals[:,:,:,1]),
+                ('L3', evals[:,:,:,2]),
+                ('V1', evecs[:,:,:,:,0]),
+                ('V2', evecs[:,:,:,:,1]),
+                ('V3', evecs[:,:,:,:,2]),
+                ('FA', maps['FA']),
+                ('MD', maps['MD']),
+                ('RD', maps['RD']),
+                ('MO', maps['MO']),
+            ]
+
+    with timer.stage('write'):
+        save_images(images, img.affine, output + '_restore_', compression,
+                    jobs)
 
-# load bvec and bvals
-bvals, bvecs = io.read_bvals_bvecs(dtibval, dtibvec)
-gtab = cg.gradient_table(bvals, bvecs)
+    # the outputs are complete, the checkpoints are not needed anymore
+    if checkpoint_dir:
+        for path in slabs:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
 
-# noise estimation from the b=0
-sigma = ne.estimate_sigma(dataraw[:,:,:,bvals==0])
-sigmamean=np.mean(sigma)
+    if timing:
+        timer.write(output + '_restore_timing.json', dtifile=dtifile,
+                    voxels=len(voxels), jobs=jobs, two_phase=two_phase,
+                    compression=compression, output_format=output_format)
 
-# tensor computation using restore
-tenmodel=dti.TensorModel(gtab,fit_method='RESTORE', sigma=sigmamean)
-tenfit = tenmodel.fit(data)
 
-# Derivated measures
-from dipy.reconst.dti import fractional_anisotropy, mean_diffusivity, radial_diffusivity, axial_diffusivity,mode
-FA = fractional_anisotropy(tenfit.evals)
-MD = mean_diffusivity(tenfit.evals)
-AD = axial_diffusivity(tenfit.evals)
-RD = radial_diffusivity(tenfit.evals)
-MO = mode(tenfit.evecs)
+# wall time, CPU time and peak RSS of each processing stage; CPU time
+# includes the worker processes, peak RSS is that of the main process
+# during the stage: the peak is reset at the start of each stage through
+# /proc/self/clear_refs, where it is not available the peak since the
+# start of the process is reported instead, as peak_rss = 'process'
+class StageTimer:
 
-tenfit.evals[np.isnan(tenfit.evals)] = 0
-evals1_img = nib.Nifti1Image(tenfit.evals[:,:,:,0].astype(np.float32), img.get_affine())
-nib.save(evals1_img, output+'_restore_L1.nii.gz')
-evals2_img = nib.Nifti1Image(tenfit.evals[:,:,:,1].astype(np.float32), img.get_affine())
-nib.save(evals2_img, output+'_restore_L2.nii.gz')
-evals3_img = nib.Nifti1Image(tenfit.evals[:,:,:,2].astype(np.float32), img.get_affine())
-nib.save(evals3_img, output+'_restore_L3.nii.gz')
+    def __init__(self):
+        self.stages = []
+        self.peak_rss = 'stage'
 
-tenfit.evecs[np.isnan(tenfit.evecs)] = 0
-evecs_img1 = nib.Nifti1Image(tenfit.evecs[:,:,:,:,0].astype(np.float32), img.get_affine())
-nib.save(evecs_img1, output+'_restore_V1.nii.gz')
-evecs_img2 = nib.Nifti1Image(tenfit.evecs[:,:,:,:,1].astype(np.float32), img.get_affine())
-nib.save(evecs_img2, output+'_restore_V2.nii.gz')
-evecs_img3 = nib.Nifti1Image(tenfit.evecs[:,:,:,:,2].astype(np.float32), img.get_affine())
-nib.save(evecs_img3, output+'_restore_V3.nii.gz')
+    @staticmethod
+    def _cpu():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (usage.ru_utime + usage.ru_stime +
+                children.ru_utime + children.ru_stime)
 
-FA[np.isnan(FA)] = 0
-fa_img = nib.Nifti1Image(FA.astype(np.float32), img.get_affine())
-nib.save(fa_img, output+'_restore_FA.nii.gz')
+    def _reset_peak_rss(self):
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            self.peak_rss = 'process'
 
-MD[np.isnan(MD)] = 0
-md_img = nib.Nifti1Image(MD.astype(np.float32), img.get_affine())
-nib.save(md_img, output+'_restore_MD.nii.gz')
+    # VmHWM in kB, or ru_maxrss which is in kB on Linux
+    def _peak_rss(self):
+        if self.peak_rss == 'stage':
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
-RD[np.isnan(RD)] = 0
-rd_img = nib.Nifti1Image(RD.astype(np.float32), img.get_affine())
-nib.save(rd_img, output+'_restore_RD.nii.gz')
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._reset_peak_rss()
+        wall = time.perf_counter()
+        cpu = self._cpu()
+        yield
+        wall = time.perf_counter() - wall
+        self.stages.append({
+            'stage': name,
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(self._cpu() - cpu, 6),
+            'peak_rss_kb': self._peak_rss(),
+        })
 
-MO[np.isnan(MO)] = 0
-mo_img = nib.Nifti1Image(MO.astype(np.float32), img.get_affine())
-nib.save(mo_img, output+'_restore_MO.nii.gz')
+    def write(self, path, **info):
+        info['peak_rss'] = self.peak_rss
+        info['stages'] = self.stages
+        info['wall_seconds'] = round(sum(x['wall_seconds']
+                                         for x in self.stages), 6)
+        info['cpu_seconds'] = round(sum(x['cpu_seconds']
+                                        for x in self.stages), 6)
+        with open(path, 'w') as f:
+            json.dump(info, f, indent=1)
+            f.write('\n')
 
 
+# manifest rows: rawfile dtifile dtibval dtibvec output [maskfile]
+def read_manifest(manifest):
+    rows = []
+    with open(manifest) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                if len(fields) not in (5, 6):
+                    raise ValueError('invalid manifest row: ' + line.strip())
+                rows.append(fields)
+    return rows
 
 
+# process all the subjects of a manifest in this interpreter, paying the
+# startup cost once; a failing subject does not stop the batch
+def process_manifest(manifest, jobs=1, compression=COMPRESSLEVEL,
+                     two_phase=False, timing=False, checkpoint_dir=None,
+                     cache_dir=None, output_format='maps'):
+    gtabs = {}
+    failed = []
+    for row in read_manifest(manifest):
+        print('Processing ' + row[1])
+        # a checkpoint subdirectory per subject
+        subject_checkpoint_dir = None
+        if checkpoint_dir:
+            subject_checkpoint_dir = os.path.join(checkpoint_dir,
+                                                  os.path.basename(row[4]))
+        try:
+            process_subject(*row, jobs=jobs, compression=compression,
+                            gtabs=gtabs, two_phase=two_phase, timing=timing,
+                            checkpoint_dir=subject_checkpoint_dir,
+                            cache_dir=cache_dir, output_format=output_format)
+        except Exception as e:
+            print('Failed ' + row[1] + ': ' + str(e), file=sys.stderr)
+            failed.append(row[1])
+    return failed
 
 
+def main(argv):
+    # arguments
+    parser = argparse.ArgumentParser(description='Robust tensor fitting with RESTORE.')
+    parser.add_argument('rawfile', nargs='?',
+                        help='diffusion weighted image non masked')
+    parser.add_argument('dtifile', nargs='?',
+                        help='diffusion weighted masked')
+    parser.add_argument('dtibval', nargs='?', help='bval file')
+    parser.add_argument('dtibvec', nargs='?', help='bvec file')
+    parser.add_argument('output', nargs='?', help='output name')
+    parser.add_argument('--manifest',
+                        help='process the subjects listed in this file, one '
+                             'row per subject: rawfile dtifile dtibval '
+                             'dtibvec output [maskfile]')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes fitting blocks of voxels '
+                             'and of threads compressing the outputs')
+    parser.add_argument('-m', '--mask',
+                        help='brain mask (default: non-zero b=0 voxels)')
+    parser.add_argument('-c', '--compression', type=int, default=COMPRESSLEVEL,
+                        choices=range(10), metavar='{0-9}',
+                        help='gzip compression level of the outputs, 0 for '
+                             'uncompressed .nii files '
+                             '(default: %(default)s)')
+    parser.add_argument('--two-phase', action='store_true',
+                        help='fit all voxels with WLS first, then run RESTORE '
+                             'only on voxels with outliers')
+    parser.add_argument('--timing', action='store_true',
+                        help='write wall time, CPU time and peak RSS of each '
+                             'stage to output_restore_timing.json')
+    parser.add_argument('--checkpoint-dir',
+                        help='save the fit of each slab of slices to this '
+                             'directory and skip the slabs already saved '
+                             'when restarting an interrupted run')
+    parser.add_argument('--cache-dir',
+                        help='cache the gradient tables and fit matrices of '
+                             'the gradient schemes in this directory')
+    parser.add_argument('--output-format', default=OUTPUT_FORMATS[0],
+                        choices=OUTPUT_FORMATS,
+                        help='write the eigenvalue, eigenvector and scalar '
+                             'maps, a single output_restore_tensor image of '
+                             'the tensor elements, or both '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+    files = (args.rawfile, args.dtifile, args.dtibval, args.dtibvec,
+             args.output)
 
+    if args.manifest:
+        if any(files) or args.mask:
+            parser.error('--manifest replaces the input and output arguments')
+        failed = process_manifest(args.manifest, args.jobs, args.compression,
+                                  args.two_phase, args.timing,
+                                  args.checkpoint_dir, args.cache_dir,
+                                  args.output_format)
+        if failed:
+            sys.exit('{} subjects failed'.format(len(failed)))
+    elif all(files):
+        process_subject(*files, maskfile=args.mask, jobs=args.jobs,
+                        compression=args.compression,
+                        two_phase=args.two_phase, timing=args.timing,
+                        checkpoint_dir=args.checkpoint_dir,
+                        cache_dir=args.cache_dir,
+                        output_format=args.output_format)
+    else:
+        parser.error('the input and output arguments are required')
 
 
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,117 @@
+# Compact tensor output of restore.py: the 6 unique elements of the
+# diffusion tensor of each voxel in a single float32 NIfTI-1 image with
+# the symmetric matrix intent, volume shape (X, Y, Z, 1, 6) and elements
+# in lower triangular order Dxx, Dxy, Dyy, Dxz, Dyz, Dzz.
+#
+# TensorStore reads such an image and computes the eigenvalues,
+# eigenvectors and scalar maps on demand, each only once:
+#
+#   store = TensorStore('subject_restore_tensor.nii.gz')
+#   fa = store.fa
+#   nib.save(store.image('fa'), 'subject_FA.nii.gz')
+
+import functools
+
+import numpy as np
+import nibabel as nib
+
+INTENT = 'symmetric matrix'
+
+# order of the tensor elements in the image, as in the NIfTI-1 standard
+LOWER_TRIANGLE = np.tril_indices(3)
+
+
+# lower triangular elements of the tensors of the voxels of a packed
+# (voxels x 3) eigenvalues array and (voxels x 3 x 3) eigenvectors array
+def pack_tensor(evals, evecs):
+    tensors = np.einsum('vij,vj,vkj->vik', evecs, evals, evecs)
+    return tensors[:, LOWER_TRIANGLE[0], LOWER_TRIANGLE[1]].astype(np.float32)
+
+
+# image of the tensors from a (X, Y, Z, 6) volume
+def tensor_image(volume, affine):
+    img = nib.Nifti1Image(volume[:, :, :, np.newaxis, :], affine)
+    img.header.set_intent(INTENT, (3,))
+    return img
+
+
+class TensorStore:
+
+    def __init__(self, path):
+        self.img = nib.load(path)
+        intent, _, _ = self.img.header.get_intent()
+        if intent != INTENT or self.img.shape[3:] != (1, 6):
+            raise ValueError(path + ' is not a symmetric tensor image')
+        self.affine = self.img.affine
+        self.shape = self.img.shape[:3]
+
+    @functools.cached_property
+    def tensor(self):
+        return np.asarray(self.img.dataobj, dtype=np.float32)[:, :, :, 0]
+
+    @functools.cached_property
+    def mask(self):
+        return np.any(self.tensor != 0, axis=-1)
+
+    # full 3 x 3 tensors of the voxels of the mask
+    def _matrices(self):
+        lower = self.tensor[self.mask]
+        matrices = np.empty((len(lower), 3, 3), dtype=np.float32)
+        matrices[:, LOWER_TRIANGLE[0], LOWER_TRIANGLE[1]] = lower
+        matrices[:, LOWER_TRIANGLE[1], LOWER_TRIANGLE[0]] = lower
+        return matrices
+
+    def _unpack(self, values):
+        volume = np.zeros(self.shape + values.shape[1:], dtype=np.float32)
+        volume[self.mask] = values
+        return volume
+
+    # eigenvalues in decreasing order, without the eigenvectors
+    @functools.cached_property
+    def _evals(self):
+        return np.linalg.eigvalsh(self._matrices())[:, ::-1]
+
+    @functools.cached_property
+    def evals(self):
+        return self._unpack(self._evals)
+
+    # eigenvectors in columns, in the order of the eigenvalues
+    @functools.cached_property
+    def evecs(self):
+        _, evecs = np.linalg.eigh(self._matrices())
+        return self._unpack(evecs[:, :, ::-1])
+
+    # the mean diffusivity does not need the eigenvalues
+    @functools.cached_property
+    def md(self):
+        return self.tensor[..., [0, 2, 5]].sum(axis=-1) / 3
+
+    @functools.cached_property
+    def ad(self):
+        return self.evals[..., 0]
+
+    @functools.cached_property
+    def rd(self):
+        return self.evals[..., 1:].mean(axis=-1)
+
+    @functools.cached_property
+    def fa(self):
+        l1, l2, l3 = self._evals.T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fa = np.sqrt(0.5 * ((l1 - l2) ** 2 + (l2 - l3) ** 2 +
+                                (l3 - l1) ** 2) / (l1 * l1 + l2 * l2 + l3 * l3))
+        return self._unpack(np.nan_to_num(fa))
+
+    @functools.cached_property
+    def mo(self):
+        l1, l2, l3 = self._evals.T
+        md = (l1 + l2 + l3) / 3
+        d1, d2, d3 = l1 - md, l2 - md, l3 - md
+        norm2 = d1 * d1 + d2 * d2 + d3 * d3
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mo = 3 * np.sqrt(6) * d1 * d2 * d3 / (norm2 * np.sqrt(norm2))
+        return self._unpack(np.clip(np.nan_to_num(mo), -1, 1))
+
+    # NIfTI image of a map, e.g. 'fa', or of the eigenvalues or eigenvectors
+    def image(self, name):
+        return nib.Nifti1Image(getattr(self, name), self.affine)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Mean skeleton measures of each subject in the whole skeleton and in each
+# region of an atlas, from the 4D all-subjects skeleton images of TBSS.
+#
+# Usage: skeleton_rois.py [options] -a atlas -o prefix NAME=skeleton ...
+#
+# NAME=skeleton = measure name and 4D skeleton image of all subjects,
+#                 e.g. FA=all_FA_skeletonised.nii.gz, may be repeated
+# --atlas    = label image in the space of the skeletons, e.g. the
+#              ICBM-DTI-81 white-matter labels atlas
+# --labels   = FSL atlas XML file with the names of the labels
+# --mask     = skeleton mask, by default the non-zero voxels of the first
+#              volume of the first skeleton image
+# --subjects = file with a subject identifier per line, in the order of
+#              the volumes of the skeleton images
+# --output   = prefix of the tables, one prefix_NAME.tsv per measure
+#
+# Means are computed over the non-zero voxels, as fslstats -M. The skeleton
+# voxels are sorted by label once, then each chunk of subject volumes is
+# reduced to the sums of all labels in a single np.add.reduceat call;
+# uncompressed images are memory-mapped.
+
+import argparse
+import csv
+import sys
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import nibabel as nib
+
+# number of subject volumes read at once
+CHUNK_SIZE = 64
+
+# name of the column of the whole skeleton
+SKELETON = 'skeleton'
+
+
+# names of the labels of an FSL atlas, by label value
+def read_labels(xmlfile):
+    names = {}
+    for label in ElementTree.parse(xmlfile).iter('label'):
+        names[int(label.get('index'))] = label.text.strip()
+    return names
+
+
+def _load(path):
+    # keep compressed images open to read successive chunks without
+    # decompressing them again from the start
+    return nib.load(path, mmap=True, keep_file_open=True)
+
+
+# flat indices of the skeleton voxels, in the Fortran order of the data of
+# NIfTI images, sorted by label, with the start of each label
+class SkeletonIndex:
+
+    def __init__(self, atlas, mask):
+        labels = atlas.ravel(order='F')
+        voxels = np.flatnonzero(mask.ravel(order='F'))
+        # the whole skeleton first, then the voxels of each label
+        labelled = voxels[labels[voxels] > 0]
+        order = np.argsort(labels[labelled], kind='stable')
+        labelled = labelled[order]
+        self.labels, starts = np.unique(labels[labelled], return_index=True)
+        self.voxels = np.concatenate([voxels, labelled])
+        self.starts = np.concatenate([[0], len(voxels) + starts])
+
+    # (subjects x regions) means of the non-zero values of a
+    # (voxels x subjects) chunk of data
+    def means(self, data):
+        values = np.asarray(data[self.voxels], dtype=np.float64)
+        sums = np.add.reduceat(values, self.starts, axis=0)
+        counts = np.add.reduceat(values != 0, self.starts, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums / counts).T
+
+
+def read_chunks(img, chunk_size=CHUNK_SIZE):
+    nvoxels = int(np.prod(img.shape[:3]))
+    for start in range(0, img.shape[3], chunk_size):
+        stop = min(start + chunk_size, img.shape[3])
+        chunk = np.asanyarray(img.dataobj[..., start:stop])
+        yield chunk.reshape((nvoxels, stop - start), order='F')
+
+
+def skeleton_means(img, index, chunk_size=CHUNK_SIZE):
+    return np.concatenate([index.means(chunk)
+                           for chunk in read_chunks(img, chunk_size)])
+
+
+def write_table(tablefile, header, subjects, means):
+    with open(tablefile, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['subject'] + header)
+        for subject, row in zip(subjects, means):
+            writer.writerow([subject] + ['{:.6g}'.format(x) for x in row])
+
+
+def _measure(text):
+    name, sep, path = text.partition('=')
+    if not sep or not name or not path:
+        raise argparse.ArgumentTypeError('expected NAME=skeleton: ' + text)
+    return name, path
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Extract mean skeleton measures per atlas region from TBSS skeleton images.')
+    parser.add_argument('skeletons',
+                        nargs='+',
+                        type=_measure,
+                        metavar='NAME=skeleton',
+                        help='measure name and 4D skeleton image of all '
+                             'subjects, e.g. FA=all_FA_skeletonised.nii.gz')
+    parser.add_argument('-a', '--atlas',
+                        required=True,
+                        help='label image in the space of the skeletons')
+    parser.add_argument('-l', '--labels',
+                        help='FSL atlas XML file with the label names')
+    parser.add_argument('-m', '--mask',
+                        help='skeleton mask (default: non-zero voxels of '
+                             'the first volume of the first skeleton image)')
+    parser.add_argument('-s', '--subjects',
+                        help='file with a subject identifier per line, in '
+                             'the order of the skeleton volumes')
+    parser.add_argument('-o', '--output',
+                        required=True,
+                        help='prefix of the output tables')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=CHUNK_SIZE,
+                        help='number of subject volumes read at once '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    images = [(name, _load(path)) for name, path in args.skeletons]
+    nsubjects = images[0][1].shape[3]
+    for name, img in images:
+        if img.shape[3] != nsubjects:
+            parser.error(name + ' has a different number of subjects')
+    if args.subjects:
+        with open(args.subjects) as f:
+            subjects = [line.strip() for line in f if line.strip()]
+        if len(subjects) != nsubjects:
+            parser.error('{} subjects listed for {} skeleton volumes'.format(
+                len(subjects), nsubjects))
+    else:
+        subjects = [str(i) for i in range(1, nsubjects + 1)]
+
+    atlas = np.asanyarray(nib.load(args.atlas).dataobj).astype(np.int64)
+    if args.mask:
+        mask = np.asanyarray(nib.load(args.mask).dataobj) > 0
+    else:
+        # all subjects are projected onto the same skeleton in TBSS
+        mask = np.any(np.asanyarray(images[0][1].dataobj[..., 0:1]) != 0,
+                      axis=-1)
+    if atlas.shape != mask.shape:
+        parser.error('the atlas and the skeletons have different shapes')
+    index = SkeletonIndex(atlas, mask)
+
+    names = read_labels(args.labels) if args.labels else {}
+    header = [SKELETON] + [names.get(label, 'label{}'.format(label))
+                           for label in index.labels]
+    for name, img in images:
+        print('Extracting ' + name)
+        means = skeleton_means(img, index, args.chunk_size)
+        write_table(args.output + '_' + name + '.tsv', header, subjects,
+                    means)
+
+
+if __name__ == "__main__":
+    main(sys.argv)